@@ -1,18 +1,26 @@
 #!/usr/bin/env python3
 """Main module providing Slurm autoscaling functions with Terraform Cloud
 """
+import fcntl
+import json
 import logging
+import os
 import re
 import sys
+import tempfile
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from enum import Enum
+from functools import lru_cache
 from os import environ
-from subprocess import run, PIPE
-from requests.exceptions import Timeout
+from subprocess import run, Popen, PIPE, CalledProcessError
+from uuid import uuid4
 
-from hostlist import expand_hostlist
-
-from .tfe import TFECLient, InvalidAPIToken, InvalidWorkspaceId
+# requests, python-hostlist and the TFE client are imported where they are used:
+# Slurm starts a new interpreter for every resume and suspend call, and paths
+# that never reach Terraform Cloud should not pay for importing them.
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)s %(message)s",
@@ -21,9 +29,27 @@ logging.basicConfig(
 )
 
 POOL_VAR = environ.get("TFE_POOL_VAR", "pool")
+WORKSPACE = environ.get("TFE_WORKSPACE", "")
+# The state shared by concurrent resume and suspend calls lives in a directory
+# writable only by the user running them, see state_dir_usable.
+STATE_DIR = environ.get(
+    "TFE_STATE_DIR",
+    os.path.join(tempfile.gettempdir(), f"slurm_autoscale_tfe-{os.geteuid()}"),
+)
+LOCK_PATH = os.path.join(STATE_DIR, "pool.lock")
+PENDING_PATH = os.path.join(STATE_DIR, "pending.json")
+APPLY_DEBOUNCE = float(environ.get("TFE_APPLY_DEBOUNCE", "2"))
+BREAKER_PATH = os.path.join(STATE_DIR, "breaker")
+BREAKER_FAILURES = 5
+BREAKER_WINDOW = 60
+
+# Hostlist made of a single range, like node[001-128]
+HOST_RANGE_REGEX = re.compile(r"^([^\[\],]+)\[(\d+)-(\d+)\]$")
 
-NODE_STATE_REGEX = re.compile(r"^NodeName=([a-z0-9-]*).*State=([A-Z_+]*).*$")
-DOWN_FLAG_SET = frozenset(["DOWN", "POWER_DOWN", "POWERED_DOWN", "POWERING_DOWN"])
+# Node state flags marking a node as not online are DOWN, POWER_DOWN,
+# POWERED_DOWN and POWERING_DOWN. They all contain DOWN and no other Slurm
+# state flag does, so a substring test finds them without splitting the state.
+DOWN_FLAG = b"DOWN"
 
 
 class AutoscaleException(Exception):
@@ -37,6 +63,196 @@ class Commands(Enum):
     SUSPEND = "suspend"
 
 
+def state_error(exc):
+    """Return the AutoscaleException reporting exc, an OSError raised while
+    accessing a file of STATE_DIR.
+    """
+    return AutoscaleException(f"Cannot access {exc.filename}: {exc.strerror}")
+
+
+@lru_cache(maxsize=None)
+def state_dir_usable():
+    """Create STATE_DIR if needed and return whether it is owned and only
+    writable by the current user, so that no other user can create or replace
+    its files. Otherwise, a warning is logged once and calls go without the
+    state shared through STATE_DIR.
+    """
+    try:
+        os.makedirs(STATE_DIR, mode=0o700, exist_ok=True)
+        state_dir_stat = os.stat(STATE_DIR)
+    except OSError as exc:
+        logging.warning("Cannot use %s: %s", STATE_DIR, exc.strerror)
+        return False
+    if state_dir_stat.st_uid != os.geteuid() or state_dir_stat.st_mode & 0o022:
+        logging.warning(
+            "Cannot use %s: it must be owned and only writable by uid %d",
+            STATE_DIR,
+            os.geteuid(),
+        )
+        return False
+    return True
+
+
+@contextmanager
+def pool_lock():
+    """Hold an exclusive flock on LOCK_PATH so concurrent resume and suspend
+    calls cannot overwrite each other's update of the TFE pool variable.
+    The lock is released by the kernel when the process exits, even if killed.
+    """
+    if not state_dir_usable():
+        yield
+        return
+    try:
+        lock_fd = os.open(LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as exc:
+        raise state_error(exc) from exc
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(lock_fd)
+
+
+def read_pending():
+    """Return the apply request recorded in PENDING_PATH: the token of the call
+    in charge of queuing the run, None when no call is, and the run messages
+    with their ids.
+    """
+    try:
+        with open(PENDING_PATH, encoding="utf-8") as pending_file:
+            return json.load(pending_file)
+    except (FileNotFoundError, ValueError):
+        return {"token": None, "messages": []}
+    except OSError as exc:
+        raise state_error(exc) from exc
+
+
+def write_pending(pending):
+    """Write the apply request to PENDING_PATH, or remove the file when it has
+    no message left.
+    """
+    try:
+        if pending["messages"]:
+            with open(PENDING_PATH, "w", encoding="utf-8") as pending_file:
+                json.dump(pending, pending_file)
+        else:
+            os.remove(PENDING_PATH)
+    except FileNotFoundError:
+        pass
+    except OSError as exc:
+        raise state_error(exc) from exc
+
+
+def queue_apply(message):
+    """Record message in PENDING_PATH as the latest request to apply the pool
+    and return a token identifying it, or None when STATE_DIR is not usable.
+    Must be called while holding pool_lock.
+    """
+    if not state_dir_usable():
+        return None
+    pending = read_pending()
+    pending["token"] = uuid4().hex
+    pending["messages"].append({"id": pending["token"], "message": message})
+    write_pending(pending)
+    return pending["token"]
+
+
+def claim_pending_apply():
+    """Take charge of the messages left in PENDING_PATH by a call that failed
+    to queue their run and return a token identifying it. Return None when no
+    message is left or another call is in charge of them.
+    Must be called while holding pool_lock.
+    """
+    if not state_dir_usable():
+        return None
+    pending = read_pending()
+    if pending["token"] is not None or not pending["messages"]:
+        return None
+    pending["token"] = uuid4().hex
+    write_pending(pending)
+    return pending["token"]
+
+
+def get_pending_apply(token):
+    """Return the messages queued in PENDING_PATH if token still identifies the
+    latest apply request, otherwise return None. The messages are kept until
+    settle_pending_apply is called. Must be called while holding pool_lock.
+    """
+    pending = read_pending()
+    if pending["token"] != token or not pending["messages"]:
+        return None
+    return pending["messages"]
+
+
+def settle_pending_apply(token, messages, applied):
+    """Remove messages from PENDING_PATH once their run is queued, wherever
+    they are: a call applying them may have been overtaken by a newer one.
+    Give up the charge of the remaining messages if token still has it, so the
+    next call queues their run. Must be called while holding pool_lock.
+    """
+    pending = read_pending()
+    if applied:
+        applied_ids = {message["id"] for message in messages}
+        pending["messages"] = [
+            message
+            for message in pending["messages"]
+            if message["id"] not in applied_ids
+        ]
+    if pending["token"] == token:
+        pending["token"] = None
+    write_pending(pending)
+
+
+def breaker_check():
+    """Raise AutoscaleException without contacting Terraform Cloud when the last
+    BREAKER_FAILURES calls failed to reach it and the last failure happened less
+    than BREAKER_WINDOW seconds ago.
+    """
+    if not state_dir_usable():
+        return
+    try:
+        with open(BREAKER_PATH, encoding="utf-8") as breaker_file:
+            last_failure, failures = breaker_file.read().split(",")
+        last_failure, failures = float(last_failure), int(failures)
+    except (FileNotFoundError, ValueError):
+        return
+    except OSError as exc:
+        raise state_error(exc) from exc
+    if failures >= BREAKER_FAILURES and time.time() - last_failure < BREAKER_WINDOW:
+        raise AutoscaleException(
+            f"Terraform cloud unreachable for the last {failures} calls"
+        )
+
+
+def breaker_record(success):
+    """Record in BREAKER_PATH whether a call reached Terraform Cloud.
+    A success resets the count of consecutive failures.
+    """
+    if not state_dir_usable():
+        return
+    try:
+        if success:
+            os.remove(BREAKER_PATH)
+            return
+        # Concurrent failures are counted under a lock on the breaker file
+        # itself, calls holding pool_lock while waiting on Terraform Cloud
+        # do not delay it.
+        breaker_fd = os.open(BREAKER_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+        with open(breaker_fd, "r+", encoding="utf-8") as breaker_file:
+            fcntl.flock(breaker_file, fcntl.LOCK_EX)
+            try:
+                failures = int(breaker_file.read().split(",")[1])
+            except (ValueError, IndexError):
+                failures = 0
+            breaker_file.seek(0)
+            breaker_file.truncate()
+            breaker_file.write(f"{time.time()},{failures + 1}")
+    except FileNotFoundError:
+        pass
+    except OSError as exc:
+        raise state_error(exc) from exc
+
+
 def change_host_state(hostlist, state, reason=None):
     """Change the state of the hostlist in Slurm with scontrol.
     Called when an exception occured and we have to revert course with
@@ -58,7 +274,7 @@ def resume(hostlist=sys.argv[-1]):
     try:
         main(Commands.RESUME, frozenset.union, hostlist)
     except AutoscaleException as exc:
-        logging.error("Failed to resume '%s': %s", hostlist, str(exc))
+        logging.error("Failed to resume '%s': %s", hostlist, exc)
         change_host_state(hostlist, "DOWN", reason=str(exc))
         return 1
     return 0
@@ -71,7 +287,7 @@ def suspend(hostlist=sys.argv[-1]):
     try:
         main(Commands.SUSPEND, frozenset.difference, hostlist)
     except AutoscaleException as exc:
-        logging.error("Failed to suspend '%s': %s", hostlist, str(exc))
+        logging.error("Failed to suspend '%s': %s", hostlist, exc)
         change_host_state(hostlist, "DOWN", reason=str(exc))
         return 1
     return 0
@@ -84,35 +300,27 @@ def connect_tfe_client():
         raise AutoscaleException(
             f"{sys.argv[0]} requires environment variable TFE_TOKEN"
         )
-    if environ.get("TFE_WORKSPACE", "") == "":
+    if WORKSPACE == "":
         raise AutoscaleException(
             f"{sys.argv[0]} requires environment variable TFE_WORKSPACE"
         )
 
-    try:
-        return TFECLient(
-            token=environ["TFE_TOKEN"],
-            workspace=environ["TFE_WORKSPACE"],
-        )
-    except InvalidAPIToken as exc:
-        raise AutoscaleException("invalid TFE API token") from exc
-    except InvalidWorkspaceId as exc:
-        raise AutoscaleException("invalid TFE workspace id") from exc
-    except Timeout as exc:
-        raise AutoscaleException("Connection to Terraform cloud timeout (5s)") from exc
+    # pylint: disable=import-outside-toplevel
+    from .tfe import TFEClient
+
+    return TFEClient(
+        token=environ["TFE_TOKEN"],
+        workspace=WORKSPACE,
+    )
 
 
 def get_pool_from_tfe(tfe_client):
     """Retrieve id and content of POOL variable from Terraform cloud
     """
-    try:
-        tfe_var = tfe_client.fetch_variable(POOL_VAR)
-    except Timeout as exc:
-        raise AutoscaleException("Connection to Terraform cloud timeout (5s)") from exc
-
+    tfe_var = tfe_client.fetch_variable(POOL_VAR)
     if tfe_var is None:
         raise AutoscaleException(
-            f'"{POOL_VAR}" variable not found in TFE workspace "{environ["TFE_WORKSPACE"]}"'
+            f'"{POOL_VAR}" variable not found in TFE workspace "{WORKSPACE}"'
         )
 
     # When the pool variable was incorrectly initialized in the workspace,
@@ -122,31 +330,79 @@ def get_pool_from_tfe(tfe_client):
     return tfe_var["id"], frozenset()
 
 
-def identify_online_nodes(tfe_pool):
-    """Identify from a list of hosts which ones are online based on Slurm."""
+def expand_hosts(hostlist):
+    """Expand a Slurm hostlist expression into a frozenset of hostnames.
+    A single hostname or a single range are expanded directly. Other expressions
+    are expanded by scontrol with Slurm's C hostlist implementation;
+    python-hostlist is used when scontrol is not available or fails.
+    """
+    if "[" not in hostlist and "," not in hostlist:
+        return frozenset((hostlist,))
+    match = HOST_RANGE_REGEX.match(hostlist)
+    if match and int(match.group(2)) <= int(match.group(3)):
+        prefix, first, last = match.groups()
+        # Zero padding follows the width of the first index, as in Slurm.
+        width = len(first)
+        return frozenset(
+            f"{prefix}{index:0{width}d}" for index in range(int(first), int(last) + 1)
+        )
+
     try:
         scontrol_run = run(
-            ["scontrol", "show", "-o", "node", ",".join(tfe_pool)],
+            ["scontrol", "show", "hostnames", hostlist],
             stdout=PIPE,
             stderr=PIPE,
-            check=False,
+            check=True,
         )
+    except (FileNotFoundError, CalledProcessError):
+        # pylint: disable=import-outside-toplevel
+        from hostlist import expand_hostlist
+
+        return frozenset(expand_hostlist(hostlist))
+    return frozenset(scontrol_run.stdout.decode().split())
+
+
+def identify_online_nodes():
+    """Identify which nodes are online based on Slurm."""
+    online_nodes = []
+    # All nodes are listed and parsed line by line as they come out of the pipe.
+    try:
+        with Popen(
+            ["scontrol", "show", "-o", "node"],
+            stdout=PIPE,
+            stderr=PIPE,
+        ) as scontrol_proc:
+            # Lines are "NodeName=<name> ... State=<flags> ...", split as bytes.
+            for line in scontrol_proc.stdout:
+                if not line.startswith(b"NodeName="):
+                    continue
+                name, _, fields = line[9:].partition(b" ")
+                _, found, state = fields.partition(b" State=")
+                if found and DOWN_FLAG not in state.split(b" ", 1)[0]:
+                    online_nodes.append(name.decode())
+            scontrol_stderr = scontrol_proc.stderr.read()
     except FileNotFoundError as exc:
         raise AutoscaleException("Cannot find command scontrol") from exc
-    if scontrol_run.stderr:
+    if scontrol_stderr:
         raise AutoscaleException(
-            f"Error while calling scontrol {scontrol_run.stderr.decode()}"
+            f"Error while calling scontrol {scontrol_stderr.decode()}"
         )
 
-    slurm_pool = []
-    for line in scontrol_run.stdout.decode().split("\n"):
-        match = NODE_STATE_REGEX.match(line)
-        if match:
-            node_state = frozenset(match.group(2).split("+"))
-            if not node_state.intersection(DOWN_FLAG_SET):
-                slurm_pool.append(match.group(1))
+    return frozenset(online_nodes)
 
-    return frozenset(slurm_pool)
+
+def report_drift(zombie_nodes):
+    """Log the nodes of the TFE pool that are not online in Slurm and return
+    the suffix added to the run message to mention their suspension.
+    """
+    if len(zombie_nodes) == 0:
+        return ""
+    zombie_nodes_string = ",".join(sorted(zombie_nodes))
+    logging.warning(
+        "TFE vs Slurm drift detected, these nodes will be suspended: %s",
+        zombie_nodes_string,
+    )
+    return f" & suspend {zombie_nodes_string} (drift detection)"
 
 
 def main(command, set_op, hostlist):
@@ -154,51 +410,136 @@ def main(command, set_op, hostlist):
     workspace indicated by TFE_WORKSPACE environment variable using the operation
     provided as set_op and the hostnames provided in hostlist.
     """
-    hosts = frozenset(expand_hostlist(hostlist))
+    hosts = expand_hosts(hostlist)
+
+    # During a Terraform Cloud outage, fail fast instead of having every
+    # resume and suspend call wait for its requests to time out.
+    breaker_check()
+
+    # The client checks the environment before the TFE modules are imported,
+    # and sends no request until update_pool.
     tfe_client = connect_tfe_client()
-    var_id, tfe_pool = get_pool_from_tfe(tfe_client)
-
-    # Verify that TFE pool corresponds to Slurm pool:
-    # When a powered up node fail to respond after slurm.conf's ResumeTimeout
-    # slurmctld marks the node as "DOWN", but it will not call the SuspendProgram
-    # on the node. Therefore, a change drift can happen between Slurm internal memory
-    # of what nodes are online and the Terraform Cloud pool variable. To limit the
-    # drift effect, we validate the state in Slurm of each node present in Terraform Cloud
-    # pool variable. We only keep the nodes that are present in Slurm.
-    slurm_pool = identify_online_nodes(tfe_pool)
-    zombie_nodes = tfe_pool - slurm_pool - hosts
-    extra_command = ""
-    if len(zombie_nodes) > 0:
-        zombie_nodes_string = ",".join(sorted(zombie_nodes))
-        logging.warning(
-            "TFE vs Slurm drift detected, these nodes will be suspended: %s",
-            zombie_nodes_string,
-        )
-        extra_command = f" & suspend {zombie_nodes_string} (drift detection)"
-
-    new_pool = set_op(slurm_pool, hosts)
-
-    if tfe_pool != new_pool:
-        try:
-            tfe_client.update_variable(var_id, list(new_pool))
-        except Timeout as exc:
-            raise AutoscaleException(
-                "Connection to Terraform cloud timeout (5s)"
-            ) from exc
-    else:
-        logging.warning(
-            'TFE pool was already correctly set when "%s %s" was issued',
-            command.value,
-            hostlist,
-        )
 
+    # pylint: disable=import-outside-toplevel
+    from requests.exceptions import HTTPError, RequestException
+    from .tfe import InvalidAPIToken, InvalidWorkspaceId, UNREACHABLE_ERRORS
+
+    # Transient errors are already retried by the TFE client session. Any
+    # request error reaching this point fails the scaling event, only errors
+    # from an unreachable or failing Terraform Cloud count for the breaker.
     try:
-        tfe_client.apply(f"Slurm {command.value} {hostlist} {extra_command}".strip())
-    except Timeout as exc:
-        raise AutoscaleException("Connection to Terraform cloud timeout (5s)") from exc
+        with tfe_client:
+            update_pool(tfe_client, command, set_op, hostlist, hosts)
+    except InvalidAPIToken as exc:
+        raise AutoscaleException("invalid TFE API token") from exc
+    except InvalidWorkspaceId as exc:
+        raise AutoscaleException("invalid TFE workspace id") from exc
+    except UNREACHABLE_ERRORS as exc:
+        breaker_record(success=False)
+        raise AutoscaleException(
+            f"Connection to Terraform cloud failed ({exc.__class__.__name__})"
+        ) from exc
+    except HTTPError as exc:
+        status_code = exc.response.status_code
+        if status_code >= 500:
+            breaker_record(success=False)
+        raise AutoscaleException(
+            f"Terraform cloud request failed with HTTP status {status_code}"
+        ) from exc
+    except RequestException as exc:
+        raise AutoscaleException(
+            f"Terraform cloud request failed ({exc.__class__.__name__})"
+        ) from exc
+    breaker_record(success=True)
+
+
+def update_pool(tfe_client, command, set_op, hostlist, hosts):
+    """Update the TFE pool variable with the operation provided as set_op and
+    queue a Terraform Cloud run to apply it.
+    """
+    # Node states in Slurm do not depend on the TFE pool. They are read in a
+    # thread started before the lock is acquired, so scontrol runs outside of
+    # the critical section and overlaps the wait for the lock and the TFE
+    # round trip. The thread exits once identify_online_nodes returns.
+    executor = ThreadPoolExecutor(max_workers=1)
+    online_nodes_future = executor.submit(identify_online_nodes)
+    executor.shutdown(wait=False)
+    with pool_lock():
+        var_id, tfe_pool = get_pool_from_tfe(tfe_client)
+        online_nodes = online_nodes_future.result()
+
+        # Verify that TFE pool corresponds to Slurm pool:
+        # When a powered up node fail to respond after slurm.conf's ResumeTimeout
+        # slurmctld marks the node as "DOWN", but it will not call the
+        # SuspendProgram on the node. Therefore, a change drift can happen between
+        # Slurm internal memory of what nodes are online and the Terraform Cloud
+        # pool variable. To limit the drift effect, we validate the state in Slurm
+        # of each node present in Terraform Cloud pool variable. We only keep the
+        # nodes that are present in Slurm.
+        slurm_pool = tfe_pool & online_nodes
+        extra_command = report_drift(tfe_pool - slurm_pool - hosts)
+
+        # slurm_pool is a subset of tfe_pool: the pool is left unchanged when no
+        # node was dropped by the drift detection and set_op would neither add
+        # nor remove any of the hosts. This is checked before building a new set.
+        if command == Commands.RESUME:
+            pool_unchanged = hosts <= slurm_pool
+        else:
+            pool_unchanged = hosts.isdisjoint(slurm_pool)
+
+        # Nothing to update means nothing new to apply either, unless an earlier
+        # call updated the pool and failed to queue its run.
+        if len(slurm_pool) == len(tfe_pool) and pool_unchanged:
+            logging.warning(
+                'TFE pool was already correctly set when "%s %s" was issued',
+                command.value,
+                hostlist,
+            )
+            token = claim_pending_apply()
+            if token is None:
+                return
+        else:
+            tfe_client.update_variable(var_id, set_op(slurm_pool, hosts))
+            message = f"Slurm {command.value} {hostlist} {extra_command}".strip()
+            token = queue_apply(message)
+
+    if token is None:
+        # Without STATE_DIR, runs cannot be merged and each call queues its own.
+        tfe_client.apply(message)
+    elif not apply_pending(tfe_client, token):
+        logging.info("%s %s (apply merged in a later run)", command.value, hostlist)
+        return
     logging.info("%s %s", command.value, hostlist)
 
 
+def apply_pending(tfe_client, token):
+    """Queue a Terraform Cloud run for the messages in PENDING_PATH if token is
+    still the latest apply request after APPLY_DEBOUNCE seconds. Return whether
+    the run was queued by this call.
+    """
+    # Slurm calls the resume and suspend programs for each set of nodes, often
+    # several in a row. Each Terraform Cloud run applies the whole pool
+    # variable, so only the last call of a burst needs to queue a run: after
+    # a quiet period, a call that was superseded leaves the apply to the newer
+    # one, which covers the pool update made here.
+    time.sleep(APPLY_DEBOUNCE)
+    with pool_lock():
+        messages = get_pending_apply(token)
+    if messages is None:
+        return False
+
+    # The messages stay in PENDING_PATH until the run is queued. If that fails,
+    # the next call queues it, even when it leaves the pool unchanged.
+    applied = False
+    try:
+        tfe_client.apply(" & ".join(message["message"] for message in messages))
+        applied = True
+    finally:
+        with pool_lock():
+            settle_pending_apply(token, messages, applied)
+    return True
+
+
 if __name__ == "__main__":
     if sys.argv[1] == Commands.RESUME.value:
         sys.exit(resume())
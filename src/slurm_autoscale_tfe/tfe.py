@@ -4,12 +4,77 @@
 import json
 
 import requests
-from requests.structures import CaseInsensitiveDict
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+# orjson is an optional, faster drop-in for the JSON (de)serialization of
+# Terraform Cloud payloads. Both variants read str or bytes and write bytes.
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+    def json_dumps(obj):
+        """Serialize obj to JSON bytes"""
+        return json.dumps(obj).encode()
+
 
 WORKSPACE_API = "https://app.terraform.io/api/v2/workspaces"
 RUNS_API = "https://app.terraform.io/api/v2/runs"
 API_CONTENT = "application/vnd.api+json"
 
+# Transient Terraform Cloud errors (rate limiting and 5xx) are retried with
+# exponential backoff instead of failing the whole resume or suspend call.
+# Creating a run is retried too: Terraform Cloud serializes runs per workspace
+# and a duplicated run only reapplies the same pool variable.
+# Retries are kept few and short: slurmctld waits for every call, and a
+# Terraform Cloud outage is handled by the circuit breaker instead.
+RETRY_TOTAL = 2
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_AFTER_MAX = 5
+RETRY_STATUS = [429, 500, 502, 503, 504]
+RETRY_METHODS = frozenset(["GET", "PATCH", "POST"])
+
+
+class BoundedRetry(Retry):
+    """Retry honouring the Retry-After header for at most RETRY_AFTER_MAX
+    seconds.
+    """
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, RETRY_AFTER_MAX)
+
+
+# urllib3 < 1.26 names the allowed_methods parameter method_whitelist.
+try:
+    RETRY = BoundedRetry(
+        total=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS,
+        allowed_methods=RETRY_METHODS,
+    )
+except TypeError:
+    # pylint: disable=unexpected-keyword-arg
+    RETRY = BoundedRetry(
+        total=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS,
+        method_whitelist=RETRY_METHODS,
+    )
+
+
+# Errors meaning Terraform Cloud could not be reached, as opposed to a request
+# it answered with an error status. RetryError is raised once the retries of
+# rate limiting and 5xx responses are exhausted.
+UNREACHABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.RetryError,
+)
+
 
 class InvalidAPIToken(Exception):
     """Raised when the TFE API token is invalid"""
@@ -19,7 +84,7 @@ class InvalidWorkspaceId(Exception):
     """Raised when the TFE workspace ID is invalid"""
 
 
-class TFECLient:
+class TFEClient:
     """TFEClient provides functions to:
     - retrieve a Terraform Cloud variable content
     - update a Terraform cloud variable content
@@ -29,50 +94,77 @@ class TFECLient:
     def __init__(self, token, workspace, timeout=5):
         self.token = token
         self.workspace = workspace
-        self.headers = CaseInsensitiveDict()
-        self.headers["Accept"] = API_CONTENT
-        self.headers["Content-Type"] = API_CONTENT
-        self.headers["Authorization"] = f"Bearer {token}"
         self.timeout = timeout
+        self.vars_url = "/".join((WORKSPACE_API, workspace, "vars"))
+
+        # A single session keeps the TLS connection to Terraform Cloud alive
+        # across the few requests issued by one resume or suspend call.
+        self.session = requests.Session()
+        self.session.headers["Accept"] = API_CONTENT
+        self.session.headers["Content-Type"] = API_CONTENT
+        self.session.headers["Authorization"] = f"Bearer {token}"
+        self.session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=RETRY),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
-        # Validate init parameters by trying to retrieve workspace
-        url = "/".join((WORKSPACE_API, self.workspace))
-        resp = requests.get(url, headers=self.headers, timeout=self.timeout).json()
-        if "errors" in resp:
-            if resp["errors"][0]["status"] == "401":
-                raise InvalidAPIToken
-            if resp["errors"][0]["status"] == "404":
-                raise InvalidWorkspaceId
+    def close(self):
+        """Close the HTTP session and its pooled connections"""
+        self.session.close()
+
+    def _request(self, method, url, **kwargs):
+        """Send a request to Terraform Cloud and return the response.
+        An authentication error raises InvalidAPIToken, any other error status
+        raises HTTPError.
+        """
+        resp = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        if resp.status_code == 401:
+            raise InvalidAPIToken
+        resp.raise_for_status()
+        return resp
 
     def fetch_variable(self, var_name):
-        """Get a workspace variable content"""
-        url = "/".join((WORKSPACE_API, self.workspace, "vars"))
-        resp = requests.get(url, headers=self.headers, timeout=self.timeout)
-        data = resp.json()["data"]
-        for var in data:
+        """Get a workspace variable content.
+        The token and workspace are not validated beforehand: this is the first
+        request of a resume or suspend call and it fails the same way.
+        """
+        try:
+            resp = self._request("GET", self.vars_url)
+        except requests.exceptions.HTTPError as exc:
+            # Only the workspace is part of this URL.
+            if exc.response.status_code == 404:
+                raise InvalidWorkspaceId from exc
+            raise
+        for var in json_loads(resp.content)["data"]:
             if var["attributes"]["key"] == var_name:
                 return {
                     "id": var["id"],
-                    "value": json.loads(var["attributes"]["value"]),
+                    "value": json_loads(var["attributes"]["value"]),
                 }
         return None
 
     def update_variable(self, var_id, value):
-        """Update a workspace variable content"""
+        """Update a workspace variable content with the sorted items of value.
+        A stable order keeps identical values byte-identical in Terraform Cloud.
+        """
         patch_data = {
             "data": {
                 "id": var_id,
                 "attributes": {
-                    "value": json.dumps(value),
+                    "value": json_dumps(sorted(value)).decode(),
                     "hcl": True,
                     "category": "terraform",
                 },
             }
         }
-        url = "/".join((WORKSPACE_API, self.workspace, "vars", var_id))
-        return requests.patch(
-            url, headers=self.headers, json=patch_data, timeout=self.timeout
-        )
+        url = "/".join((self.vars_url, var_id))
+        return self._request("PATCH", url, data=json_dumps(patch_data))
 
     def apply(self, message):
         """Queue a workspace run"""
@@ -84,6 +176,8 @@ class TFECLient:
                 },
             }
         }
-        return requests.post(
-            RUNS_API, headers=self.headers, json=run_data, timeout=self.timeout
-        )
+        return self._request("POST", RUNS_API, data=json_dumps(run_data))
+
+
+# Deprecated: former, misspelled name of TFEClient.
+TFECLient = TFEClient